@@ -1,49 +1,153 @@
 import os
-import json
+import posixpath
 import logging
 import time
+import random
+import threading
+import queue
+import functools
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from types import MappingProxyType
 import boto3
 import paramiko
-from botocore.exceptions import ClientError
+from botocore.config import Config
+from botocore.exceptions import ClientError, CredentialRetrievalError
+from boto3.s3.transfer import TransferConfig
 from s3transfer import S3Transfer
 import numpy as np
 from tqdm import tqdm
+try:
+    import orjson
+
+    def _dumps(obj):
+        return orjson.dumps(obj).decode()
+except ImportError:
+    import json
+    _dumps = json.dumps
 from . import __version__
 
 logger = logging.getLogger(__name__)
 
+_LOCK = threading.Lock()
 
-class DataLake:
+_SFTP_WINDOW_SIZE = 2 ** 27
+_TRANSFER_CONFIG = TransferConfig(multipart_threshold=8 * 1024 * 1024, max_concurrency=10, use_threads=True)
+_CLIENT_CONFIG = Config(retries={'max_attempts': 10, 'mode': 'adaptive'}, max_pool_connections=50)
 
-    def __init__(self, region, aws_access_key=None, aws_secret_key=None):
+_TRANSIENT_ERROR_CODES = {'Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'TooManyRequestsException',
+                          'SlowDown', 'ServiceUnavailable', 'ServiceFailure', 'InternalError', 'InternalFailure'}
+
+# only the resources / service principal vary between calls, so the documents are kept pre-serialised
+_POLICY_TEMPLATE = ('{"Version":"2012-10-17","Statement":['
+                    '{"Sid":"AllowListingOfUserFolder","Effect":"Allow",'
+                    '"Action":["s3:ListBucket","s3:GetBucketLocation"],"Resource":%s},'
+                    '{"Sid":"HomeDirAccess","Effect":"Allow",'
+                    '"Action":["s3:PutObject","s3:GetObject","s3:DeleteObject","s3:DeleteObjectVersion",'
+                    '"s3:GetObjectVersion","s3:GetObjectACL","s3:PutObjectACL"],"Resource":%s}]}')
+_TRUST_TEMPLATE = ('{"Version":"2012-10-17","Statement":[{"Sid":"Permit","Effect":"Allow",'
+                   '"Principal":{"Service":"%s.amazonaws.com"},"Action":"sts:AssumeRole"}]}')
+
+_DEFAULT_SERVER_KWARGS = MappingProxyType({'Domain': 'S3',
+                                           'EndpointType': 'PUBLIC',
+                                           'Protocols': ('SFTP',),
+                                           'IdentityProviderType': 'SERVICE_MANAGED',
+                                           'SecurityPolicyName': 'TransferSecurityPolicy-2020-06'})
+
+
+@functools.lru_cache(maxsize=None)
+def _get_session(access_key=None, secret_key=None):
+    # one session per set of credentials so the provider chain is resolved only once
+    return boto3.session.Session(aws_access_key_id=access_key, aws_secret_access_key=secret_key)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_client(service, region, access_key=None, secret_key=None):
+    # boto3 sessions are not thread-safe, client creation is serialised
+    with _LOCK:
+        return _get_session(access_key, secret_key).client(service_name=service, region_name=region,
+                                                           config=_CLIENT_CONFIG)
+
+
+def _is_transient(error):
+    if isinstance(error, CredentialRetrievalError):
+        return True
+    return (error.response['Error'].get('Code') in _TRANSIENT_ERROR_CODES
+            or error.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0) >= 500)
+
+
+def retry(tries=6, base=0.2, max_delay=5):
+    # exponential backoff with full jitter, only for throttling, 5xx and credential lookup failures
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            for attempt in range(tries):
+                try:
+                    return func(*args, **kwargs)
+                except (ClientError, CredentialRetrievalError) as e:
+                    if attempt == tries - 1 or not _is_transient(e):
+                        raise
+                    delay = min(max_delay, base * 2 ** attempt)
+                    logger.warning('Retrying %s in %.2fs: %s', getattr(func, '__name__', func), delay, e)
+                    time.sleep(random.uniform(0, delay))
+        return wrapper
+    return decorator
 
-        if aws_access_key is None:
-            self.s3_client = boto3.client('s3', region_name=region)
-            self.iam_client = boto3.client('iam', region_name=region)
-            self.transfer_client = boto3.client('transfer', region_name=region)
-            self.s3_resource = boto3.resource(service_name='s3')
-        else:
-            self.s3_client = boto3.client(service_name='s3',
-                                          region_name=region,
-                                          aws_access_key_id=aws_access_key,
-                                          aws_secret_access_key=aws_secret_key)
 
-            self.iam_client = boto3.client(service_name='iam',
-                                           region_name=region,
-                                           aws_access_key_id=aws_access_key,
-                                           aws_secret_access_key=aws_secret_key)
+def _call(operation, **kwargs):
+    # wrapping the client method itself keeps the AWS operation name in the retry log
+    return retry()(operation)(**kwargs)
 
-            self.transfer_client = boto3.client(service_name='transfer',
-                                                region_name=region,
-                                                aws_access_key_id=aws_access_key,
-                                                aws_secret_access_key=aws_secret_key)
+
+def _remote_path(local_path, remote_folder_path=None):
+    file_name = os.path.basename(local_path)
+    if remote_folder_path is None:
+        return file_name
+    return posixpath.join(remote_folder_path, file_name)
+
+
+def _paginate(client, operation, result_key, **kwargs):
+    for page in client.get_paginator(operation).paginate(**kwargs):
+        yield from page.get(result_key, [])
+
+
+class DataLake:
+
+    __slots__ = ('region', 'aws_access_key', 'aws_secret_key', 's3_client', 'iam_client', 'transfer_client',
+                 's3_resource', 'server_id', 'sftp', 'pool_size', '_ssh_clients', '_sftp_key', '_sftp_pool',
+                 '_sftp_pool_lock', '_sftp_semaphore', '_account_id', '_server_transfer_client')
+
+    def __init__(self, region, aws_access_key=None, aws_secret_key=None, pool_size=None):
+
+        self.s3_client = _get_client('s3', region, aws_access_key, aws_secret_key)
+        self.iam_client = _get_client('iam', region, aws_access_key, aws_secret_key)
+        self.transfer_client = _get_client('transfer', region, aws_access_key, aws_secret_key)
+        if aws_access_key is None:
+            with _LOCK:
+                self.s3_resource = _get_session().resource(service_name='s3')
 
         self.region = region
         self.aws_access_key = aws_access_key
         self.aws_secret_key = aws_secret_key
         self.server_id = None
-        self.client = None
         self.sftp = None
+        self._server_transfer_client = None
+        # AWS Transfer Family allows 10 channels per SSH connection, one of them is self.sftp
+        self.pool_size = pool_size or min(os.cpu_count() or 1, 9)
+        self._ssh_clients = {}
+        self._sftp_key = None
+        self._sftp_pool = {}
+        self._sftp_pool_lock = threading.Lock()
+        self._sftp_semaphore = threading.Semaphore(self.pool_size)
+        self._account_id = None
+
+    @property
+    def account_id(self):
+
+        if self._account_id is None:
+            sts_client = _get_client('sts', self.region, self.aws_access_key, self.aws_secret_key)
+            self._account_id = sts_client.get_caller_identity()['Account']
+        return self._account_id
 
     def create_bucket(self, bucket_name):
         """Create an S3 bucket in a specified region
@@ -51,83 +155,78 @@ class DataLake:
         Args:
            bucket_name (str): Bucket to create
 
-        Returns: True if bucket created, else False
+        Returns: True if bucket created or already in this region, else False
         """
-        assert isinstance(bucket_name, str)
+        if self._bucket_region(bucket_name) == self.region:
+            logger.warning(f'Bucket {bucket_name} already exists')
+            return True
+        kwargs = {'Bucket': bucket_name}
+        # us-east-1 is the default location and S3 rejects it as an explicit constraint
+        if self.region != 'us-east-1':
+            kwargs['CreateBucketConfiguration'] = {'LocationConstraint': self.region}
         try:
-            location = {'LocationConstraint': self.region}
-            self.s3_client.create_bucket(Bucket=bucket_name, CreateBucketConfiguration=location)
+            _call(self.s3_client.create_bucket, **kwargs)
             print(f"Created bucket {bucket_name}")
         except ClientError as e:
+            # a retried request may find the bucket created by the attempt that got a 5xx
+            if e.response['Error']['Code'] == 'BucketAlreadyOwnedByYou':
+                logger.warning(f'Bucket {bucket_name} already exists')
+                return True
             logger.error(e)
             return False
         return True
 
+    def _bucket_region(self, bucket_name):
+        try:
+            response = self.s3_client.head_bucket(Bucket=bucket_name)
+        except ClientError:
+            return None
+        return response['ResponseMetadata']['HTTPHeaders'].get('x-amz-bucket-region')
+
+    def iter_buckets(self):
+
+        if self.s3_client.can_paginate('list_buckets'):
+            # PageSize sets MaxBuckets, without it the first page already holds every bucket
+            buckets = _paginate(self.s3_client, 'list_buckets', 'Buckets', PaginationConfig={'PageSize': 1000})
+        else:
+            # botocore releases before ListBuckets pagination return everything in one call
+            buckets = self.s3_client.list_buckets()['Buckets']
+        for bucket in buckets:
+            yield bucket['Name']
+
     @property
     def list_buckets(self):
 
-        return [name for name in self.s3_client.list_buckets()['Buckets']['Name']]
+        return list(self.iter_buckets())
+
+    def iter_policies(self, scope='Local'):
+
+        yield from _paginate(self.iam_client, 'list_policies', 'Policies', Scope=scope)
 
     def delete_bucket(self, bucket_name):
-        assert isinstance(bucket_name, str)
         self.s3_client.delete_bucket(Bucket=bucket_name)
 
     def create_iam_s3_access_policy(self, bucket_name_list, policy_name):
         primary_resource_list = [f"arn:aws:s3:::{bucket}" for bucket in bucket_name_list]
-        secondary_resource_list = [f"arn:aws:s3:::{bucket}/*" for bucket in bucket_name_list]
-        policy = {"Version": "2012-10-17", "Statement": [
-            {"Sid": "AllowListingOfUserFolder",
-             "Effect": "Allow",
-             "Action": ["s3:ListBucket", "s3:GetBucketLocation"],
-             "Resource": primary_resource_list},
-            {"Sid": "HomeDirAccess",
-             "Effect": "Allow",
-             "Action": [
-                 "s3:PutObject",
-                 "s3:GetObject",
-                 "s3:DeleteObject",
-                 "s3:DeleteObjectVersion",
-                 "s3:GetObjectVersion",
-                 "s3:GetObjectACL",
-                 "s3:PutObjectACL"
-             ],
-             "Resource": secondary_resource_list
-             }
-        ]}
+        secondary_resource_list = [f"{resource}/*" for resource in primary_resource_list]
+        policy = _POLICY_TEMPLATE % (_dumps(primary_resource_list), _dumps(secondary_resource_list))
         try:
-            response = self.iam_client.create_policy(PolicyName=policy_name, PolicyDocument=json.dumps(policy))
+            response = _call(self.iam_client.create_policy, PolicyName=policy_name, PolicyDocument=policy)
             response = response['Policy']
         except ClientError as e:
             if e.response['Error']['Code'] == 'EntityAlreadyExists':
                 logger.warning(f'Policy {policy_name} already exists')
-                policies = self.iam_client.list_policies()['Policies']
-                i = 0
-                while policies[i]['PolicyName'] != policy_name:
-                    i += 1
-                    continue
-                response = policies[i]
+                policy_arn = f'arn:aws:iam::{self.account_id}:policy/{policy_name}'
+                response = self.iam_client.get_policy(PolicyArn=policy_arn)['Policy']
             else:
                 raise e
 
         return response['PolicyName'], response['Arn']
 
     def create_role_and_attach_policy(self, service, iam_role_name, policies_arn=None):
-        trust_relationships = {
-            "Version": "2012-10-17",
-            "Statement": [
-                {
-                    "Sid": "Permit",
-                    "Effect": "Allow",
-                    "Principal": {
-                        "Service": f"{service}.amazonaws.com"
-                    },
-                    "Action": "sts:AssumeRole"
-                }
-            ]
-        }
         try:
-            response_role = self.iam_client.create_role(RoleName=iam_role_name,
-                                                        AssumeRolePolicyDocument=json.dumps(trust_relationships))
+            response_role = _call(self.iam_client.create_role, RoleName=iam_role_name,
+                                  AssumeRolePolicyDocument=_TRUST_TEMPLATE % service)
             logger.info('Created role %s.', response_role['Role']['RoleName'])
         except ClientError as e:
             if e.response['Error']['Code'] == 'EntityAlreadyExists':
@@ -137,28 +236,27 @@ class DataLake:
                 logger.exception("Could not create role %s. Here's why: %s.", iam_role_name,
                                  e.response['Error']['Message'])
                 raise
-        if policies_arn is not None:
-            for policy_arn in policies_arn:
-                try:
-                    self.iam_client.attach_role_policy(RoleName=iam_role_name, PolicyArn=policy_arn)
-                except ClientError as e:
-                    logger.exception("Could not attach policy%s. Here's why: %s.", policy_arn,
-                                     e.response['Error']['Message'])
-        else:
-            pass
+        policies_arn = list(policies_arn) if policies_arn is not None else []
+        if policies_arn:
+            # low-level clients are thread-safe, so the attachments can run concurrently
+            with ThreadPoolExecutor(max_workers=min(10, len(policies_arn))) as executor:
+                futures = {executor.submit(_call, self.iam_client.attach_role_policy, RoleName=iam_role_name,
+                                           PolicyArn=policy_arn): policy_arn for policy_arn in policies_arn}
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                    except ClientError as e:
+                        logger.exception("Could not attach policy %s. Here's why: %s.", futures[future],
+                                         e.response['Error']['Message'])
 
         return response_role['Role']['RoleName'], response_role['Role']['Arn']
 
     def create_sftp_transfer_server(self, logging_role_arn, custom_config=False, **kwargs):
+        if not custom_config:
+            # kwargs given alongside the defaults override single fields
+            kwargs = {**_DEFAULT_SERVER_KWARGS, 'LoggingRole': logging_role_arn, **kwargs}
         try:
-            if custom_config:
-                response = self.transfer_client.create_server(**kwargs)
-            else:
-                response = self.transfer_client.create_server(Domain='S3', EndpointType='PUBLIC',
-                                                              Protocols=['SFTP'],
-                                                              IdentityProviderType='SERVICE_MANAGED',
-                                                              SecurityPolicyName='TransferSecurityPolicy-2020-06',
-                                                              LoggingRole=logging_role_arn)
+            response = _call(self.transfer_client.create_server, **kwargs)
         except ClientError as e:
             logger.exception("Could not create server. Here's why: %s", e.response['Error']['Message'])
             raise
@@ -170,67 +268,158 @@ class DataLake:
         try:
             if server_id is None:
                 server_id = self.server_id
-            response = self.transfer_client.create_user(UserName=user_name,
-                                                        HomeDirectoryType='LOGICAL',
-                                                        HomeDirectoryMappings=directory_mappings,
-                                                        Role=access_role_arn,
-                                                        SshPublicKeyBody=public_key,
-                                                        ServerId=server_id)
+            response = _call(self.transfer_client.create_user, UserName=user_name,
+                             HomeDirectoryType='LOGICAL',
+                             HomeDirectoryMappings=directory_mappings,
+                             Role=access_role_arn,
+                             SshPublicKeyBody=public_key,
+                             ServerId=server_id)
         except ClientError as e:
             logger.error(e)
             raise
 
         return response
 
-    def AWS(self, service, region=None):
+    def get_client(self, service, access_key=None, secret_key=None, region=None):
 
+        if access_key is None:
+            access_key, secret_key = self.aws_access_key, self.aws_secret_key
         if region is None:
             region = self.region
 
-        self.client = boto3.client(service_name=service,
-                                   aws_access_key_id=self.aws_access_key,
-                                   aws_secret_access_key=self.aws_secret_key,
-                                   region_name=region)
+        return _get_client(service, region, access_key, secret_key)
 
-    def establish_sftp(self, user_name, private_key, server_id=None):
+    def establish_sftp(self, user_name, private_key, server_id=None, transfer_client=None):
 
-        self.AWS(service='transfer')
+        if transfer_client is None:
+            transfer_client = self.transfer_client
+        # remembered so the server is stopped through the client that started it
+        self._server_transfer_client = transfer_client
 
         if server_id is None:
             server_id = self.server_id
         elif server_id is not None:
             self.server_id = server_id
 
-        server_status = self.client.describe_server(ServerId=server_id)['Server']['State']
+        server_status = transfer_client.describe_server(ServerId=server_id)['Server']['State']
 
         if server_status == 'STOPPING':
-            while server_status != 'OFFLINE':
-                server_status = self.client.describe_server(ServerId=server_id)['Server']['State']
-                continue
-        else:
-            pass
-        self.client.start_server(ServerId=server_id)
+            transfer_client.get_waiter('server_offline').wait(ServerId=server_id,
+                                                              WaiterConfig={'Delay': 5, 'MaxAttempts': 60})
+            server_status = 'OFFLINE'
+
+        if server_status == 'OFFLINE':
+            transfer_client.start_server(ServerId=server_id)
 
         if server_status != 'ONLINE':
-            while server_status != 'ONLINE':
-                server_status = self.client.describe_server(ServerId=server_id)['Server']['State']
-                continue
-        else:
-            pass
+            transfer_client.get_waiter('server_online').wait(ServerId=server_id,
+                                                             WaiterConfig={'Delay': 5, 'MaxAttempts': 60})
 
         print('Server is online now')
-        #time.sleep(15)
-        #host = f'{server_id}.server.transfer.eu-central-1.amazonaws.com'  # copy the AWS transfer endpoint
-        #ssh_client = paramiko.SSHClient()
-        #policy = paramiko.AutoAddPolicy()
-        #ssh_client.set_missing_host_key_policy(policy)
-        #ssh_client.connect(host, username=user_name, pkey=paramiko.RSAKey.from_private_key_file(private_key))
-        #self.sftp = ssh_client.open_sftp()
-
-        #print('SFTP connection is open now')
+        host = f'{server_id}.server.transfer.{transfer_client.meta.region_name}.amazonaws.com'
+        if self._sftp_key != (host, user_name) and self.sftp is not None:
+            # the main channel belongs to another server or user
+            self.sftp.close()
+            self.sftp = None
+        self._sftp_key = (host, user_name)
+        ssh_client = self._ssh_clients.get(self._sftp_key)
+        if ssh_client is None or not ssh_client.get_transport().is_active():
+            ssh_client = paramiko.SSHClient()
+            policy = paramiko.AutoAddPolicy()
+            ssh_client.set_missing_host_key_policy(policy)
+            ssh_client.connect(host, username=user_name, pkey=paramiko.RSAKey.from_private_key_file(private_key))
+            transport = ssh_client.get_transport()
+            # avoid renegotiating keys in the middle of large transfers
+            transport.packetizer.REKEY_BYTES = pow(2, 40)
+            transport.packetizer.REKEY_PACKETS = pow(2, 40)
+            self._ssh_clients[self._sftp_key] = ssh_client
+            # channels pooled on a dead transport cannot be reused
+            with self._sftp_pool_lock:
+                self._sftp_pool.pop(self._sftp_key, None)
+            self.sftp = None
+        if self.sftp is None or self.sftp.get_channel().closed:
+            self.sftp = self._open_sftp(self._sftp_key)
+
+        print('SFTP connection is open now')
 
         return self
 
+    def _open_sftp(self, key):
+        ssh_client = self._ssh_clients.get(key)
+        if ssh_client is None:
+            raise RuntimeError(f'No SFTP connection for {key}, call establish_sftp first')
+        transport = ssh_client.get_transport()
+        return paramiko.SFTPClient.from_transport(transport, window_size=_SFTP_WINDOW_SIZE)
+
+    @contextmanager
+    def acquire_sftp(self, key=None):
+        # pooled clients are extra channels on the already authenticated transport, no new handshake
+        if key is None:
+            key = self._sftp_key
+        if key is None:
+            raise RuntimeError('No SFTP connection, call establish_sftp first')
+        self._sftp_semaphore.acquire()
+        try:
+            with self._sftp_pool_lock:
+                pool = self._sftp_pool.setdefault(key, queue.SimpleQueue())
+            try:
+                sftp = pool.get_nowait()
+            except queue.Empty:
+                sftp = self._open_sftp(key)
+        except BaseException:
+            self._sftp_semaphore.release()
+            raise
+        try:
+            yield sftp
+        except BaseException:
+            sftp.close()
+            self._sftp_semaphore.release()
+            raise
+        self.release_sftp(sftp, key)
+
+    def release_sftp(self, sftp, key=None):
+        if key is None:
+            key = self._sftp_key
+        with self._sftp_pool_lock:
+            pool = self._sftp_pool.get(key)
+            if pool is None:
+                # the connection was closed while the client was in use
+                sftp.close()
+            else:
+                pool.put(sftp)
+        self._sftp_semaphore.release()
+
+    def close_sftp(self):
+        with self._sftp_pool_lock:
+            for pool in self._sftp_pool.values():
+                while not pool.empty():
+                    pool.get_nowait().close()
+            self._sftp_pool.clear()
+        if self.sftp is not None:
+            self.sftp.close()
+            self.sftp = None
+        for ssh_client in self._ssh_clients.values():
+            ssh_client.close()
+        self._ssh_clients.clear()
+
+    def put_file_transfer(self, local_path, remote_folder_path=None):
+        # paramiko pipelines the write requests, the large channel window keeps them in flight
+        remote_path = _remote_path(local_path, remote_folder_path)
+        with self.acquire_sftp() as sftp:
+            sftp.put(local_path, remote_path)
+        return remote_path
+
+    def put_files(self, local_paths, remote_folder_path=None):
+        with ThreadPoolExecutor(max_workers=self.pool_size) as executor:
+            return list(executor.map(lambda path: self.put_file_transfer(path, remote_folder_path), local_paths))
+
+    def put_file_direct(self, local_path, bucket_name, key=None):
+        # the transfer server writes to S3 anyway, uploading directly skips the SFTP hop
+        if key is None:
+            key = os.path.basename(local_path)
+        self.s3_client.upload_file(local_path, bucket_name, key, Config=_TRANSFER_CONFIG)
+        return key
+
     def upload(self, local_path, bucket_name, remote_folder_path=None, folder=False):
         # remote path to have a forward slash in the end test/
         transfer = S3Transfer(self.s3_client)
@@ -276,12 +465,13 @@ class DataLake:
 
     def list_files(self, bucket_name, last_n=None, remote_folder_path=None):
 
-        object_list = [obj['Key'] for obj in self.s3_client.list_objects(Bucket=f'{bucket_name}')['Contents']]
-        object_dates = [obj['LastModified'] for obj in self.s3_client.list_objects(Bucket=f'{bucket_name}')['Contents']]
-
-        if remote_folder_path is not None:
-            object_list = [obj['Key'] for obj in self.s3_client.list_objects(Bucket=f'{bucket_name}', Prefix=remote_folder_path)['Contents']]
-            object_dates = [obj['LastModified'] for obj in self.s3_client.list_objects(Bucket=f'{bucket_name}', Prefix=remote_folder_path)['Contents']]
+        if remote_folder_path is None:
+            objects = list(_paginate(self.s3_client, 'list_objects_v2', 'Contents', Bucket=bucket_name))
+        else:
+            objects = list(_paginate(self.s3_client, 'list_objects_v2', 'Contents', Bucket=bucket_name,
+                                     Prefix=remote_folder_path))
+        object_list = [obj['Key'] for obj in objects]
+        object_dates = [obj['LastModified'] for obj in objects]
 
         if last_n is None:
             return object_list
@@ -309,9 +499,43 @@ class DataLake:
                     break
 
 
-    def close_transfer_server(self):
-        self.sftp.close()
-        self.client.stop_server(ServerId=self.server_id)
+    def close_transfer_server(self, transfer_client=None, wait=False):
+        if transfer_client is None:
+            transfer_client = self._server_transfer_client or self.transfer_client
+        self.close_sftp()
+        transfer_client.stop_server(ServerId=self.server_id)
+        self._server_transfer_client = None
+        if wait:
+            transfer_client.get_waiter('server_offline').wait(ServerId=self.server_id,
+                                                              WaiterConfig={'Delay': 5, 'MaxAttempts': 60})
         print('Server is offline now')
 
+    @contextmanager
+    def session(self, user_name, private_key, server_id=None, transfer_client=None, wait=False):
+        # the server is stopped even if the upload fails, so it does not keep running (and billing)
+        try:
+            self.establish_sftp(user_name, private_key, server_id=server_id, transfer_client=transfer_client)
+            yield self.sftp
+        except BaseException:
+            if self.server_id is None:
+                self.close_sftp()
+            else:
+                try:
+                    self.close_transfer_server(wait=wait)
+                except Exception:
+                    # keep the original error, a failed stop is only logged
+                    logger.exception('Could not stop server %s', self.server_id)
+            raise
+        self.close_transfer_server(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # set by establish_sftp before the server is started, so a failed connect still stops it
+        if self._server_transfer_client is not None and self.server_id is not None:
+            self.close_transfer_server()
+        else:
+            self.close_sftp()
+
 
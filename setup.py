@@ -12,7 +12,8 @@ setup(
     install_requires=[
         'boto3',
         'botocore',
-        'paramiko'
+        'paramiko',
+        'orjson'
     ],
     license='Apache License 2.0',
     classifier=[